@@ -1,26 +1,52 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import google.transit.gtfs_realtime_pb2 as gtfs_rt
 import time
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
+from google.protobuf.internal import api_implementation
 from google.protobuf.message import DecodeError
+import hashlib
+import heapq
 import logging
+import re
+import threading
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# protobuf>=4.25 defaults to upb; streamlit has already loaded protobuf by the
+# time this script runs, so the backend can only be chosen in the environment.
+PURE_PYTHON_PROTOBUF = api_implementation.Type() not in ("upb", "cpp")
+if PURE_PYTHON_PROTOBUF:
+    logger.warning(f"Using {api_implementation.Type()} protobuf implementation; "
+                   f"only feed entities for our stations will be decoded")
+
 # Constants
 G_TRAIN_FEED = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-g"
 SEVEN_TRAIN_FEED = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs"
-EASTERN_TZ = pytz.timezone('America/New_York')
+EASTERN_TZ = ZoneInfo('America/New_York')
+REFRESH_INTERVAL = 30  # seconds
 
-# Station IDs remain the same...
+# Station IDs
 GREENPOINT_AVE_G = "G26N"
 GREENPOINT_AVE_G_S = "G26S"
 VERNON_JACKSON_7 = "721N"
 VERNON_JACKSON_7_S = "721S"
+G_STATIONS = [GREENPOINT_AVE_G_S]
+SEVEN_STATIONS = [VERNON_JACKSON_7, VERNON_JACKSON_7_S]
+G_ROUTES = frozenset({"G"})
+SEVEN_ROUTES = frozenset({"7", "7X"})
+DIRECTIONS = {
+    GREENPOINT_AVE_G_S: "Church Ave-bound",
+    VERNON_JACKSON_7: "Manhattan-bound",
+    VERNON_JACKSON_7_S: "Flushing-bound",
+}
 
 # CSS for the 8-bit train animation and styling
 CUSTOM_CSS = """
@@ -151,142 +177,309 @@ TRAIN_HTML = """
 </div>
 """
 
+def _minify_css(css):
+    """Strip comments and collapse whitespace in a CSS block."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r"\s*([{};,])\s*", r"\1", css).strip()
+
+# Static page markup, sent as a single element outside the refresh fragment
+PAGE_HTML = _minify_css(CUSTOM_CSS) + TRAIN_HTML
+
 def setup_page():
     st.set_page_config(page_title="MTA Tracker", page_icon="🚇")
     st.title("MTA Tracker")
-    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
-    st.markdown(TRAIN_HTML, unsafe_allow_html=True)
+    st.markdown(PAGE_HTML, unsafe_allow_html=True)
 
-def fetch_feed(url):
-    headers = {
+def _make_session():
+    """HTTP session reused across refreshes so TCP/TLS connections stay open."""
+    session = requests.Session()
+    session.headers.update({
         'Accept': 'application/x-google-protobuf',
+        'Accept-Encoding': 'gzip, deflate',
         'User-Agent': 'Mozilla/5.0'
-    }
+    })
+    # Both feeds live on the same host and are fetched concurrently, so keep
+    # one pooled connection per in-flight request.
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+    return session
+
+def _fetch_bytes(session, url):
+    with session.get(url, timeout=10, stream=True) as response:
+        response.raise_for_status()
+        # Read the decompressed body in one call rather than via
+        # response.content's chunked iteration and join.
+        raw = response.raw.read(decode_content=True)
     
+    logger.info(f"Feed response: status={response.status_code}, "
+               f"content-type={response.headers.get('content-type')}, "
+               f"content-encoding={response.headers.get('content-encoding')}, "
+               f"length={len(raw)}")
+    
+    return raw
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def _scan_entities(raw, needles):
+    """Yield serialized FeedEntity messages from raw that contain any needle.
+
+    Walks only the top level of the FeedMessage wire format, skipping the
+    header and every entity whose bytes never mention one of our stop IDs,
+    so the slow pure-Python decoder only sees the few entities we use.
+    """
+    pos, end = 0, len(raw)
+    while pos < end:
+        key, pos = _read_varint(raw, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            _, pos = _read_varint(raw, pos)
+            continue
+        if wire_type == 1:
+            length = 8
+        elif wire_type == 5:
+            length = 4
+        elif wire_type == 2:
+            length, pos = _read_varint(raw, pos)
+        else:
+            raise DecodeError(f"Unexpected wire type {wire_type}")
+        if pos + length > end:
+            raise DecodeError("Truncated feed message")
+        if wire_type == 2 and field_number == 2 and any(raw.find(n, pos, pos + length) != -1 for n in needles):
+            yield raw[pos:pos + length]
+        pos += length
+
+def _parse(raw, station_ids):
+    feed = gtfs_rt.FeedMessage()
+    # Stop IDs are stored verbatim in the wire format, so a substring miss
+    # means no entity can match and the decode can be skipped.
+    needles = [station_id.encode() for station_id in station_ids]
+    if not any(needle in raw for needle in needles):
+        return feed
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        logger.info(f"Feed response: status={response.status_code}, "
-                   f"content-type={response.headers.get('content-type')}, "
-                   f"length={len(response.content)}")
-        
-        feed = gtfs_rt.FeedMessage()
-        try:
-            feed.ParseFromString(response.content)
-            return feed
-        except DecodeError as e:
-            logger.error(f"Protobuf decode error: {e}")
-            st.error(f"Error decoding transit data")
-            return None
-            
-    except Exception as e:
-        logger.error(f"Feed fetch error: {e}")
-        st.error("Unable to fetch transit data")
+        if PURE_PYTHON_PROTOBUF:
+            for entity in _scan_entities(raw, needles):
+                feed.entity.add().MergeFromString(entity)
+        else:
+            feed.ParseFromString(raw)
+        return feed
+    except (DecodeError, IndexError) as e:
+        logger.error(f"Protobuf decode error: {e}")
         return None
 
+def fetch_feeds(session, sources):
+    """Download feeds concurrently and return the parsed feeds in order.
+
+    sources is a list of (url, station_ids) pairs. A feed that fails to
+    download or decode comes back as None.
+    """
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        futures = [pool.submit(_fetch_bytes, session, url) for url, _ in sources]
+    
+    feeds = []
+    for future, (_, station_ids) in zip(futures, sources):
+        try:
+            raw = future.result()
+        except Exception as e:
+            logger.error(f"Feed fetch error: {e}")
+            feeds.append(None)
+            continue
+        feeds.append(_parse(raw, station_ids))
+    return feeds
+
 def is_express_train(trip_update):
-    try:
-        route_id = trip_update.trip.route_id
-        return route_id == "7X" or "..express.." in str(trip_update.trip.trip_id).lower()
-    except:
-        return False
+    trip = trip_update.trip
+    if trip.route_id == "7X":
+        return True
+    trip_id = trip.trip_id
+    return "..express.." in trip_id or "..EXPRESS.." in trip_id
 
 def convert_to_eastern_time(timestamp):
     """Convert UTC timestamp to Eastern Time."""
-    utc_dt = datetime.fromtimestamp(timestamp, pytz.UTC)
-    eastern_dt = utc_dt.astimezone(EASTERN_TZ)
-    return eastern_dt
+    return datetime.fromtimestamp(timestamp, EASTERN_TZ)
+
+def process_train_times(feed, station_ids, route_ids, per_direction, current_time):
+    """Collect arrivals after current_time at station_ids in one pass over the feed.
 
-def process_train_times(feed, station_ids, line_type):
-    """Process train times for specified station IDs and line type"""
+    Only trips on route_ids are inspected; the numbered-line feed carries
+    every A Division route, so this skips most trips with one comparison.
+
+    Returns a dict mapping direction label to at most per_direction
+    (arrival_time, is_express) pairs, earliest first, in DIRECTIONS order.
+    """
     if not feed:
-        return []
+        return {}
     
-    arrival_times = []
-    current_time = int(time.time())
+    arrivals = {}
+    station_ids = frozenset(station_ids)
+    direction_for = DIRECTIONS.get
     
     try:
         for entity in feed.entity:
-            if entity.HasField('trip_update'):
-                update = entity.trip_update
-                for stop_time in update.stop_time_update:
-                    if stop_time.stop_id in station_ids:
-                        if stop_time.HasField('arrival'):
-                            arrival_time = stop_time.arrival.time
-                            if arrival_time > current_time:
-                                if line_type == 'G' and stop_time.stop_id.endswith('N'):
-                                    continue
-                                    
-                                direction = "Church Ave-bound" if line_type == 'G' else \
-                                          "Manhattan-bound" if stop_time.stop_id.endswith('N') else "Flushing-bound"
-                                
-                                is_express = is_express_train(update)
-                                arrival_times.append((arrival_time, direction, is_express))
+            # Unset sub-messages read as empty defaults, so entities without a
+            # trip_update have an empty route_id and are skipped here too.
+            update = entity.trip_update
+            if update.trip.route_id not in route_ids:
+                continue
+            is_express = None
+            for stop_time in update.stop_time_update:
+                stop_id = stop_time.stop_id
+                if stop_id not in station_ids:
+                    continue
+                direction = direction_for(stop_id)
+                if direction is None:
+                    continue
+                # An unset arrival reads as time 0 and fails this check
+                arrival_time = stop_time.arrival.time
+                if arrival_time > current_time:
+                    if is_express is None:
+                        is_express = is_express_train(update)
+                    arrivals.setdefault(direction, []).append((arrival_time, is_express))
         
-        if line_type == '7':
-            manhattan_bound = [(t, d, e) for t, d, e in arrival_times if d == "Manhattan-bound"]
-            flushing_bound = [(t, d, e) for t, d, e in arrival_times if d == "Flushing-bound"]
-            
-            manhattan_bound.sort(key=lambda x: x[0])
-            flushing_bound.sort(key=lambda x: x[0])
-            
-            return manhattan_bound[:3] + flushing_bound[:3]
-        else:
-            return sorted(arrival_times, key=lambda x: x[0])[:6]
+        return {
+            direction: heapq.nsmallest(per_direction, arrivals[direction], key=itemgetter(0))
+            for direction in DIRECTIONS.values()
+            if direction in arrivals
+        }
     
     except Exception as e:
         logger.error(f"Error processing times: {e}")
-        return []
+        return {}
 
-def display_train_times(times, station_name, train_line):
+def display_train_times(arrivals, station_name, train_line):
     css_class = "g-time" if train_line == "G" else "seven-time"
     line_color = "#6CBE45" if train_line == "G" else "#B933AD"
     
-    st.markdown(f'<h3 style="color: {line_color};">{train_line} Train - {station_name}</h3>', unsafe_allow_html=True)
+    html = [f'<h3 style="color: {line_color};">{train_line} Train - {station_name}</h3>']
     
-    if not times:
-        st.markdown(f'<div class="{css_class} time-display">No upcoming trains</div>', unsafe_allow_html=True)
+    if not arrivals:
+        html.append(f'<div class="{css_class} time-display">No upcoming trains</div>')
     else:
-        for arrival_time, direction, is_express in times:
-            eastern_time = convert_to_eastern_time(arrival_time)
-            time_str = eastern_time.strftime("%I:%M %p").lstrip("0").lower()
-            express_badge = '<span class="express-badge">EXPRESS</span>' if is_express else ''
-            st.markdown(
-                f'<div class="{css_class} time-display">{direction} - {time_str} {express_badge}</div>',
-                unsafe_allow_html=True
-            )
+        for direction, times in arrivals.items():
+            for arrival_time, is_express in times:
+                eastern_time = convert_to_eastern_time(arrival_time)
+                time_str = eastern_time.strftime("%I:%M %p").lstrip("0").lower()
+                express_badge = '<span class="express-badge">EXPRESS</span>' if is_express else ''
+                html.append(f'<div class="{css_class} time-display">{direction} - {time_str} {express_badge}</div>')
+    
+    st.markdown("".join(html), unsafe_allow_html=True)
+
+def load_arrivals(session):
+    """Fetch both feeds and return (g_times, seven_times).
+
+    A line's times are None when its feed could not be loaded.
+    """
+    g_feed, seven_feed = fetch_feeds(session, [
+        (G_TRAIN_FEED, G_STATIONS),
+        (SEVEN_TRAIN_FEED, SEVEN_STATIONS),
+    ])
+    
+    now = int(time.time())
+    g_times = process_train_times(g_feed, G_STATIONS, G_ROUTES, 6, now) if g_feed else None
+    seven_times = process_train_times(seven_feed, SEVEN_STATIONS, SEVEN_ROUTES, 3, now) if seven_feed else None
+    return g_times, seven_times
+
+def upcoming(arrivals, current_time):
+    """Drop arrivals at or before current_time, and directions left empty."""
+    upcoming_arrivals = {}
+    for direction, times in arrivals.items():
+        times = [t for t in times if t[0] > current_time]
+        if times:
+            upcoming_arrivals[direction] = times
+    return upcoming_arrivals
+
+class FeedRefresher:
+    """Polls the MTA feeds on a daemon thread and keeps the latest arrivals.
 
+    Rendering reads the most recent snapshot instead of waiting on the
+    network, and the feeds are polled once per interval no matter how many
+    sessions are open. Each line keeps its last good (times, fetched_at)
+    pair, so a failed refresh leaves older data in place rather than
+    wiping it.
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._session = _make_session()
+        self._snapshot = (None, None)
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name="feed-refresher", daemon=True).start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                g_times, seven_times = load_arrivals(self._session)
+            except Exception as e:
+                logger.error(f"Feed refresh error: {e}")
+            else:
+                fetched_at = int(time.time())
+                g_line, seven_line = self._snapshot
+                self._snapshot = (
+                    g_line if g_times is None else (g_times, fetched_at),
+                    seven_line if seven_times is None else (seven_times, fetched_at),
+                )
+            self._ready.set()
+            self._stop.wait(self._interval)
+        self._session.close()
+
+    def stop(self):
+        self._stop.set()
+
+    def latest(self, timeout=15):
+        """Return (g_line, seven_line), waiting up to timeout for the first refresh.
+
+        Each line is a (times, fetched_at) pair, or None if it has never loaded.
+        """
+        self._ready.wait(timeout)
+        return self._snapshot
+
+# Keyed on the script's contents so an edited script replaces the refresher
+# (which would otherwise keep running the old code) instead of adding one.
+CODE_VERSION = hashlib.sha1(Path(__file__).read_bytes()).hexdigest()
+
+@st.cache_resource(max_entries=1, on_release=FeedRefresher.stop)
+def get_refresher(code_version):
+    return FeedRefresher(REFRESH_INTERVAL)
+
+@st.fragment(run_every=REFRESH_INTERVAL)
 def update_displays():
     with st.spinner("Loading train data..."):
-        g_feed = fetch_feed(G_TRAIN_FEED)
-        seven_feed = fetch_feed(SEVEN_TRAIN_FEED)
+        g_line, seven_line = get_refresher(CODE_VERSION).latest()
     
+    now = int(time.time())
     col1, col2 = st.columns(2)
     
     with col1:
-        if g_feed:
-            g_times = process_train_times(g_feed, [GREENPOINT_AVE_G_S], 'G')
-            display_train_times(g_times, "Greenpoint Ave", "G")
+        if g_line is None:
+            st.error("Unable to fetch transit data")
+        else:
+            display_train_times(upcoming(g_line[0], now), "Greenpoint Ave", "G")
     
     with col2:
-        if seven_feed:
-            seven_times = process_train_times(seven_feed, [VERNON_JACKSON_7, VERNON_JACKSON_7_S], '7')
-            display_train_times(seven_times, "Vernon-Jackson", "7")
+        if seven_line is None:
+            st.error("Unable to fetch transit data")
+        else:
+            display_train_times(upcoming(seven_line[0], now), "Vernon-Jackson", "7")
     
-    current_eastern = datetime.now(EASTERN_TZ)
-    st.markdown(f"Last updated: {current_eastern.strftime('%I:%M:%S %p %Z')}")
+    loaded = [line[1] for line in (g_line, seven_line) if line is not None]
+    if loaded:
+        # Report the older of the two, so the label never overstates freshness
+        current_eastern = convert_to_eastern_time(min(loaded))
+        st.markdown(f"Last updated: {current_eastern.strftime('%I:%M:%S %p %Z')}")
 
 def main():
     setup_page()
     
     try:
-        placeholder = st.empty()
-        while True:
-            with placeholder.container():
-                update_displays()
-            time.sleep(30)
-            placeholder.empty()
+        update_displays()
     
     except Exception as e:
         logger.error(f"Main loop error: {e}")